@@ -1,51 +1,144 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.responses import JSONResponse, HTMLResponse
+from contextlib import asynccontextmanager
 import uvicorn
+import asyncio
 import cv2
 import numpy as np
 import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-import face_recognition
-import pickle
 import requests
-os.system("pip install dlib-bin")
+import aiofiles
 
-from main import encode_known_faces
-
-app = FastAPI()
+from gallery import (
+    ARCHIVE_FILE,
+    ENCODINGS_FILE,
+    LEGACY_PICKLE_FILE,
+    NAMES_FILE,
+    atomic_open,
+    available_cpus,
+    convert_legacy_pickle,
+    unpack_archive,
+)
 
 # === CONFIG ===
+FIREBASE_NPZ_URL = "https://firebasestorage.googleapis.com/v0/b/testcitrufy.appspot.com/o/face_encodings.npz?alt=media"
+LOCAL_NPZ_PATH = ARCHIVE_FILE
+# Legacy pickle gallery, converted once if no .npz has been uploaded yet
 FIREBASE_PKL_URL = "https://firebasestorage.googleapis.com/v0/b/testcitrufy.appspot.com/o/face_encodings.pkl?alt=media"
-LOCAL_PKL_PATH = "face_encodings.pkl"
+LOCAL_PKL_PATH = LEGACY_PICKLE_FILE
+LOCAL_NPY_PATH = ENCODINGS_FILE
+LOCAL_NAMES_PATH = NAMES_FILE
+# Each worker loads its own dlib models; set this to the container's CPU limit
+RECOGNITION_WORKERS = int(os.environ.get("RECOGNITION_WORKERS", available_cpus()))
+MAX_UPLOAD_BYTES = 10_000_000  # larger request bodies are rejected with 413
+JPEG_MAGIC = b"\xff\xd8\xff"
+PNG_MAGIC = b"\x89PNG\r\n\x1a\n"
+
+# === Sniff the upload type from its first bytes ===
+def image_extension(img_bytes):
+    """Return ".jpg" / ".png" for JPEG / PNG uploads, None for anything else."""
+    if img_bytes[:3] == JPEG_MAGIC:
+        return ".jpg"
+    if img_bytes[:8] == PNG_MAGIC:
+        return ".png"
+    return None
+
+# === Download a file from Firebase Storage unless cached locally ===
+def download_if_missing(url, path):
+    if os.path.exists(path):
+        return
+    print(f"⬇️ Downloading {path} from Firebase Storage...")
+    with requests.get(url, stream=True) as r:
+        if r.status_code != 200:
+            raise Exception(f"Failed to download {path} (HTTP {r.status_code})")
+
+        # Stream to a temp file next to the target, then rename atomically
+        with atomic_open(path) as f:
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, f)
+    print(f"✅ Successfully downloaded {path}.")
+
+# === Make sure the gallery files exist locally ===
+def fetch_encodings():
+    """
+    Download and unpack the gallery if it is not cached yet. Only the
+    worker processes load it; the web process never runs matching.
+    """
+    if os.path.exists(LOCAL_NPY_PATH) and os.path.exists(LOCAL_NAMES_PATH):
+        print("✅ Encodings available locally.")
+        return
 
-# === Load known encodings from Firebase or local cache ===
-def load_encodings():
     try:
-        if not os.path.exists(LOCAL_PKL_PATH):
-            print("⬇️ Downloading face_encodings.pkl from Firebase Storage...")
-            r = requests.get(FIREBASE_PKL_URL)
-            if r.status_code == 200:
-                with open(LOCAL_PKL_PATH, "wb") as f:
-                    f.write(r.content)
-                print("✅ Successfully downloaded encodings file.")
-            else:
-                raise Exception(f"Failed to download file (HTTP {r.status_code})")
-
-        print("✅ Loading encodings from local file...")
-        with open(LOCAL_PKL_PATH, "rb") as f:
-            data = pickle.load(f)
-            return data["encodings"], data["names"]
+        download_if_missing(FIREBASE_NPZ_URL, LOCAL_NPZ_PATH)
+        unpack_archive(LOCAL_NPZ_PATH)
+        print("✅ Encodings available locally.")
+        return
+    except Exception as e:
+        print(f"⚠️ Could not load {LOCAL_NPZ_PATH}: {e}")
 
+    try:
+        download_if_missing(FIREBASE_PKL_URL, LOCAL_PKL_PATH)
+        convert_legacy_pickle(LOCAL_PKL_PATH)
+        print(f"✅ Converted {LOCAL_PKL_PATH}; upload {LOCAL_NPZ_PATH} to Firebase Storage.")
     except Exception as e:
         print(f"❌ Error loading encodings: {e}")
-        return [], []
+        print("❌ Starting with an EMPTY gallery: every face will be Unknown until /reencode runs.")
 
-# Load encodings at startup
-known_encodings, known_names = load_encodings()
+# === Worker pool for the CPU-bound recognition pipeline ===
+def _in_worker(task, *args):
+    """Run worker.<task> in a pool process; only workers import the dlib pipeline."""
+    import worker
+    return getattr(worker, task)(*args)
 
-@app.get("/", response_class=HTMLResponse)
-def upload_form():
-    return """
+def make_executor():
+    # spawn, not fork: a forked child cannot use CUDA once the runtime exists
+    return ProcessPoolExecutor(
+        max_workers=RECOGNITION_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_in_worker,
+        initargs=("init_worker",),
+    )
+
+def restart_executor(broken):
+    """Replace a pool whose worker died (segfault, OOM kill) so later requests work."""
+    global executor
+    if executor is broken:
+        executor = make_executor()
+        broken.shutdown(wait=False)
+
+executor = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global executor
+    fetch_encodings()
+    executor = make_executor()
+    yield
+    executor.shutdown(wait=False, cancel_futures=True)
+
+app = FastAPI(lifespan=lifespan)
+
+# === Reject oversized bodies before the multipart form is parsed ===
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    length = request.headers.get("content-length")
+    if length is None:
+        if "chunked" in request.headers.get("transfer-encoding", "").lower():
+            return JSONResponse(status_code=411, content={"error": "Content-Length required"})
+    else:
+        if not length.isdigit():
+            return JSONResponse(status_code=400, content={"error": "Invalid Content-Length"})
+        if int(length) > MAX_UPLOAD_BYTES:
+            return JSONResponse(status_code=413, content={"error": "Image too large"})
+    return await call_next(request)
+
+# === Upload form (static, built once) ===
+UPLOAD_FORM_HTML = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -147,31 +240,32 @@ def upload_form():
         </script>
     </body>
     </html>
-    """
+"""
+
+@app.get("/", response_class=HTMLResponse)
+def upload_form():
+    return HTMLResponse(UPLOAD_FORM_HTML, headers={"Cache-Control": "public, max-age=3600"})
 
 @app.post("/recognize")
 async def recognize(image: UploadFile = File(...)):
     try:
         img_bytes = await image.read()
-        np_arr = np.frombuffer(img_bytes, np.uint8)
-        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
 
-        if image is None:
+        # Reject non-images before paying for a worker round trip and decode
+        if image_extension(img_bytes) is None:
             return JSONResponse(status_code=400, content={"error": "Invalid image"})
 
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        face_locations = face_recognition.face_locations(rgb_image)
-        face_encodings = face_recognition.face_encodings(rgb_image, face_locations)
+        pool = executor
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                pool, _in_worker, "recognize_bytes", img_bytes
+            )
+        except BrokenProcessPool:
+            restart_executor(pool)
+            return JSONResponse(status_code=503, content={"error": "Recognition worker crashed, please retry"})
 
-        result = []
-        for face_encoding in face_encodings:
-            matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
-            name = "Unknown"
-            if True in matches:
-                face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-                best_match = np.argmin(face_distances)
-                name = known_names[best_match]
-            result.append(name)
+        if result is None:
+            return JSONResponse(status_code=400, content={"error": "Invalid image"})
 
         return {"recognized": result}
 
@@ -181,9 +275,18 @@ async def recognize(image: UploadFile = File(...)):
 @app.post("/reencode")
 async def reencode_faces():
     try:
-        global known_encodings, known_names
-        known_encodings, known_names = encode_known_faces("dataset", save_encodings=True)
-        return {"status": "success", "count": len(known_encodings)}
+        global executor
+        pool = executor
+        try:
+            count = await asyncio.get_running_loop().run_in_executor(pool, _in_worker, "reencode", "dataset")
+        except BrokenProcessPool:
+            restart_executor(pool)
+            return JSONResponse(status_code=503, content={"error": "Encoding worker crashed, please retry"})
+
+        # Fresh workers load the new gallery; the old pool finishes its queue
+        old_executor, executor = executor, make_executor()
+        old_executor.shutdown(wait=False)
+        return {"status": "success", "count": count}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
@@ -191,19 +294,25 @@ async def reencode_faces():
 @app.post("/collect")
 async def collect_person_image(name: str = Form(...), file: UploadFile = File(...)):
     try:
-        person_dir = os.path.join("dataset", name)
-        os.makedirs(person_dir, exist_ok=True)
-
         img_bytes = await file.read()
-        np_arr = np.frombuffer(img_bytes, np.uint8)
-        image = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
 
-        if image is None:
+        ext = image_extension(img_bytes)
+        if ext is None:
+            return JSONResponse(status_code=400, content={"error": "Invalid image format"})
+
+        # Validate with a cheap 1/8-scale grayscale decode
+        np_arr = np.frombuffer(img_bytes, np.uint8)
+        if cv2.imdecode(np_arr, cv2.IMREAD_REDUCED_GRAYSCALE_8) is None:
             return JSONResponse(status_code=400, content={"error": "Invalid image format"})
 
-        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
+        person_dir = os.path.join("dataset", name)
+        os.makedirs(person_dir, exist_ok=True)
+
+        # Stored as uploaded, without a decode/encode round trip
+        filename = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
         filepath = os.path.join(person_dir, filename)
-        cv2.imwrite(filepath, image)
+        async with aiofiles.open(filepath, "wb") as f:
+            await f.write(img_bytes)
 
         return {"status": "success", "path": filepath}
     except Exception as e:
@@ -0,0 +1,231 @@
+import os
+import json
+import pickle
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import faiss
+except ImportError:  # fall back to NumPy matching
+    faiss = None
+
+try:
+    from numba import njit
+except ImportError:  # fall back to BLAS matching
+    njit = None
+
+ENCODINGS_FILE = "encodings.npy"
+NAMES_FILE = "names.json"
+ARCHIVE_FILE = "face_encodings.npz"  # compressed copy uploaded to Firebase Storage
+LEGACY_PICKLE_FILE = "face_encodings.pkl"  # format used before the .npy gallery
+TOLERANCE = 0.6
+EMBEDDING_DIM = 128  # dlib face descriptor size
+PREFILTER_TOP_K = 32  # int8 candidates refined with exact float similarities
+SQ8_MIN_GALLERY = 10_000  # galleries this large use an int8 Faiss prefilter
+HNSW_MIN_GALLERY = 50_000  # galleries this large use approximate HNSW search
+JIT_MAX_GALLERY = 2_000  # galleries up to this size use the fused Numba kernel
+
+# === Utility: Usable CPUs ===
+def available_cpus():
+    """CPUs this process may run on (affinity-aware where the OS supports it)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# mkstemp creates 0600 files; read the umask once so replaced files get the usual mode
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# === Utility: Gallery matrix ===
+def to_matrix(encodings):
+    """
+    Stack encodings into a contiguous float32 (N, 128) matrix.
+    Done once at load time so recognition never re-stacks the list.
+    """
+    if len(encodings) == 0:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    return np.ascontiguousarray(encodings, dtype=np.float32)
+
+# === Utility: Unit-length rows ===
+def normalize_rows(encodings):
+    """
+    L2-normalize every row so a single dot product gives cosine similarity.
+    """
+    encodings = to_matrix(encodings)
+    norms = np.linalg.norm(encodings, axis=1, keepdims=True)
+    return encodings / np.maximum(norms, 1e-12)
+
+def _exact_nearest(known_encodings, probes):
+    """
+    Most similar gallery row for every probe from one (N, M) matrix product.
+    """
+    similarities = known_encodings @ probes.T
+    best = similarities.argmax(axis=0)
+    return best, similarities[best, np.arange(len(probes))]
+
+if njit is not None:
+    @njit(fastmath=True, cache=True, boundscheck=False)
+    def _jit_nearest(known, probes):
+        """
+        Fused dot product + running max in one pass over the gallery,
+        without a BLAS call or an (N, M) temporary. Serial: a request has
+        only a few probes, and each pool worker is already one CPU.
+        The inner loop runs to the constant EMBEDDING_DIM so LLVM can fully
+        unroll it into packed FMA instructions.
+        """
+        n = known.shape[0]
+        m = probes.shape[0]
+        best = np.empty(m, np.int64)
+        best_similarities = np.empty(m, np.float32)
+        for j in range(m):
+            best_i = 0
+            best_sim = -np.inf
+            for i in range(n):
+                sim = np.float32(0.0)  # float32 accumulator keeps 8 lanes per AVX2 op
+                for k in range(EMBEDDING_DIM):
+                    sim += known[i, k] * probes[j, k]
+                if sim > best_sim:
+                    best_sim = sim
+                    best_i = i
+            best[j] = best_i
+            best_similarities[j] = best_sim
+        return best, best_similarities
+
+# === Utility: Faiss index for the gallery ===
+def build_index(known_encodings):
+    """
+    Inner-product Faiss index over the unit-length gallery rows.
+    Exact IndexFlatIP for normal galleries; for larger ones an int8 scalar
+    quantizer ranks the gallery and the top PREFILTER_TOP_K candidates are
+    refined with float32 similarities; IndexHNSWFlat for very large ones.
+    Returns None when faiss is not installed, the gallery is empty, or
+    match_faces will use the Numba kernel anyway (no index copy is kept).
+    """
+    if faiss is None or len(known_encodings) == 0:
+        return None
+    if njit is not None and len(known_encodings) <= JIT_MAX_GALLERY:
+        return None
+
+    known_encodings = to_matrix(known_encodings)
+    if len(known_encodings) >= HNSW_MIN_GALLERY:
+        index = faiss.IndexHNSWFlat(EMBEDDING_DIM, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = 64
+    elif len(known_encodings) >= SQ8_MIN_GALLERY:
+        index = faiss.IndexRefineFlat(faiss.IndexScalarQuantizer(
+            EMBEDDING_DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        ))
+        index.k_factor = PREFILTER_TOP_K
+        index.train(known_encodings)
+    else:
+        index = faiss.IndexFlatIP(EMBEDDING_DIM)
+    index.add(known_encodings)
+    return index
+
+# === Utility: Match faces against the gallery ===
+def match_faces(known_encodings, known_names, face_encodings, tolerance=TOLERANCE, index=None):
+    """
+    Return a list of (name, distance) for each probe encoding.
+    known_encodings must have unit-length rows (see normalize_rows); the
+    reported distance is the Euclidean distance between unit vectors.
+    Small galleries use the Numba kernel when available; otherwise pass
+    index (from build_index) to search with Faiss.
+    """
+    if len(face_encodings) == 0:
+        return []
+    if len(known_encodings) == 0:
+        return [("Unknown", None)] * len(face_encodings)
+
+    probes = normalize_rows(face_encodings)
+    if (
+        njit is not None
+        and len(known_encodings) <= JIT_MAX_GALLERY
+        and known_encodings.shape[1] == probes.shape[1] == EMBEDDING_DIM
+    ):
+        best, best_similarities = _jit_nearest(np.asarray(known_encodings), probes)
+    elif index is not None:
+        similarities, ids = index.search(probes, 1)
+        best, best_similarities = ids[:, 0], similarities[:, 0]
+    else:
+        best, best_similarities = _exact_nearest(known_encodings, probes)
+
+    # For unit vectors |a-b|^2 = 2 - 2 a.b, so tolerance 0.6 is similarity 0.82
+    cos_thresh = 1 - tolerance ** 2 / 2
+    best_distances = np.sqrt(np.maximum(2.0 - 2.0 * best_similarities, 0.0))
+    return [
+        (known_names[i], float(d)) if sim >= cos_thresh else ("Unknown", float(d))
+        for i, sim, d in zip(best, best_similarities, best_distances)
+    ]
+
+# === Utility: Atomic file replacement ===
+@contextmanager
+def atomic_open(path, mode="wb"):
+    """
+    Write to a unique temp file next to path and rename it over path when
+    the block succeeds, so concurrent writers and readers never see a torn
+    file (readers that have the old file memory-mapped keep the old inode).
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0o666 & ~_UMASK)  # os.fchmod is POSIX-only
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _write_mappable(known_encodings, known_names, encodings_path=ENCODINGS_FILE, names_path=NAMES_FILE):
+    """Write the .npy + JSON pair that load_gallery memory-maps."""
+    with atomic_open(encodings_path) as f:
+        np.save(f, known_encodings)
+    with atomic_open(names_path, "w") as f:
+        json.dump(list(known_names), f)
+
+# === Utility: Persist the gallery ===
+def save_gallery(known_encodings, known_names):
+    """
+    Save encodings as a raw float32 .npy matrix of unit-length rows and
+    names as JSON, plus a compressed .npz archive of both for Firebase.
+    """
+    known_encodings = normalize_rows(known_encodings)
+    _write_mappable(known_encodings, known_names)
+    
+    # Compressed archive for distribution (no pickle inside)
+    with atomic_open(ARCHIVE_FILE) as f:
+        np.savez_compressed(f, encodings=known_encodings, names=np.asarray(known_names))
+
+def load_gallery(encodings_path=ENCODINGS_FILE, names_path=NAMES_FILE):
+    """
+    Memory-map the saved encodings (pages are read on demand) and load names.
+    Files written before rows were normalized are rewritten once with
+    unit-length rows, since match_faces relies on them.
+    """
+    known_encodings = np.load(encodings_path, mmap_mode="r")
+    with open(names_path, "r") as f:
+        known_names = json.load(f)
+
+    # Galleries are saved all-normalized or not at all, so one row tells
+    if len(known_encodings) and not np.isclose(np.linalg.norm(known_encodings[0]), 1.0, atol=1e-3):
+        print(f"⚠ {encodings_path} has non-unit rows; rewriting it normalized")
+        _write_mappable(normalize_rows(known_encodings), known_names, encodings_path, names_path)
+        known_encodings = np.load(encodings_path, mmap_mode="r")
+    return known_encodings, known_names
+
+
+def unpack_archive(archive_path=ARCHIVE_FILE):
+    """
+    Expand a compressed .npz archive into the memory-mappable .npy + JSON pair.
+    """
+    with np.load(archive_path) as data:
+        _write_mappable(normalize_rows(data["encodings"]), data["names"].tolist())
+
+
+def convert_legacy_pickle(pkl_path=LEGACY_PICKLE_FILE):
+    """
+    One-time migration from the old pickled {"encodings", "names"} dict.
+    Writes the memory-mappable pair and the .npz archive via save_gallery.
+    """
+    with open(pkl_path, "rb") as f:
+        data = pickle.load(f)
+    save_gallery(data["encodings"], data["names"])
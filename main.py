@@ -1,13 +1,47 @@
 import sys
 import cv2
+import dlib
 import face_recognition
+import numpy as np
 import os
-import pickle
 import csv
+from PIL import Image, ImageOps
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+from gallery import (
+    ARCHIVE_FILE,
+    ENCODINGS_FILE,
+    EMBEDDING_DIM,
+    LEGACY_PICKLE_FILE,
+    NAMES_FILE,
+    available_cpus,
+    build_index,
+    convert_legacy_pickle,
+    load_gallery,
+    match_faces,
+    normalize_rows,
+    save_gallery,
+    to_matrix,
+    unpack_archive,
+)
+
 ATTENDANCE_FILE = "attendance.csv"
 
+# === Utility: Attendance already logged ===
+def load_logged_attendance():
+    """
+    Read attendance.csv once into a set of (name, date) pairs.
+    """
+    if not os.path.exists(ATTENDANCE_FILE):
+        return set()
+    with open(ATTENDANCE_FILE, "r", newline="") as f:
+        rows = list(csv.reader(f))
+    return {(row[0], row[1]) for row in rows[1:] if len(row) >= 2}
+
+_logged = load_logged_attendance()
+
 # === Utility: Log attendance ===
 def mark_attendance(name):
     """
@@ -17,82 +51,139 @@ def mark_attendance(name):
     today = datetime.now().strftime("%Y-%m-%d")
     now_time = datetime.now().strftime("%H:%M:%S")
 
+    # Check if already logged today
+    if (name, today) in _logged:
+        return
+
     # If file doesn't exist, create with header
     if not os.path.exists(ATTENDANCE_FILE):
         with open(ATTENDANCE_FILE, "w", newline="") as f:
             writer = csv.writer(f)
             writer.writerow(["Name", "Date", "Time"])
 
-    # Check if already logged today
-    with open(ATTENDANCE_FILE, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            if name in line and today in line:
-                return  # Already logged today
-
     # Append new record
     with open(ATTENDANCE_FILE, "a", newline="") as f:
         writer = csv.writer(f)
         writer.writerow([name, today, now_time])
+    _logged.add((name, today))
     print(f"✅ Attendance marked for {name} at {now_time}")
 
+# === Utility: Encode all faces of one image in a batch ===
+def batch_face_encodings(image, face_locations, num_jitters=1):
+    """
+    Same result as face_recognition.face_encodings, but every face chip is
+    passed to the dlib ResNet in a single call so a CUDA build runs them as
+    one GPU batch instead of one forward pass per face.
+    """
+    if len(face_locations) == 0:
+        return []
+
+    landmarks = dlib.full_object_detections(
+        face_recognition.api._raw_face_landmarks(image, face_locations, model="small")
+    )
+    descriptors = face_recognition.api.face_encoder.compute_face_descriptor(image, landmarks, num_jitters)
+    return [np.array(d) for d in descriptors]
+
+# === Utility: Load an image with EXIF orientation applied ===
+def load_image_upright(image_path):
+    """
+    Like face_recognition.load_image_file, but rotates the pixels according
+    to the EXIF orientation tag. Uploads are stored as sent, so portrait
+    phone photos would otherwise be encoded sideways.
+    """
+    with Image.open(image_path) as im:
+        return np.array(ImageOps.exif_transpose(im).convert("RGB"))
+
+# === Utility: Encode one gallery image ===
+def _encode_one(item):
+    """
+    Return (encoding, error) for one (person_name, image_name, image_path).
+    encoding is None when no face is found.
+    """
+    _, _, image_path = item
+    try:
+        # Load image
+        image = load_image_upright(image_path)
+        
+        # Get face encodings
+        encodings = face_recognition.face_encodings(image)
+        return (encodings[0] if len(encodings) > 0 else None), None
+    
+    except Exception as e:
+        return None, str(e)
+
 # === STEP 1: Encode known faces ===
-def encode_known_faces(folder_path="known_faces", save_encodings=True):
+def encode_known_faces(folder_path="known_faces", save_encodings=True, workers=None):
     """
     Load images and create face encodings.
     Folder structure: known_faces/PersonName/image1.jpg, image2.jpg...
+    workers caps the number of encoding processes (default: available CPUs);
+    never more processes than images are started.
     """
-    known_encodings = []
-    known_names = []
-    
     if not os.path.exists(folder_path):
         print(f"Creating {folder_path} folder...")
         os.makedirs(folder_path)
         print(f"\nPlease create folders for each person:")
         print(f"  {folder_path}/John/photo1.jpg")
         print(f"  {folder_path}/Jane/photo1.jpg")
-        return known_encodings, known_names
+        return to_matrix([]), []
     
     print("Encoding faces from known_faces folder...\n")
     
-    # Loop through each person's folder
+    # Collect (person, image) pairs first so the gallery can be preallocated
+    image_paths = []
     for person_name in os.listdir(folder_path):
         person_path = os.path.join(folder_path, person_name)
         
         if not os.path.isdir(person_path):
             continue
         
-        print(f"Processing: {person_name}")
-        
-        # Loop through images for this person
         for image_name in os.listdir(person_path):
             if image_name.lower().endswith(('.png', '.jpg', '.jpeg')):
-                image_path = os.path.join(person_path, image_name)
-                
-                try:
-                    # Load image
-                    image = face_recognition.load_image_file(image_path)
-                    
-                    # Get face encodings
-                    encodings = face_recognition.face_encodings(image)
-                    
-                    if len(encodings) > 0:
-                        known_encodings.append(encodings[0])
-                        known_names.append(person_name)
-                        print(f"  ✓ {image_name}")
-                    else:
-                        print(f"  ✗ No face found in {image_name}")
-                
-                except Exception as e:
-                    print(f"  ✗ Error loading {image_name}: {e}")
+                image_paths.append((person_name, image_name, os.path.join(person_path, image_name)))
+    
+    # One contiguous float32 row per image; trimmed to the faces found
+    buf = np.empty((len(image_paths), EMBEDDING_DIM), dtype=np.float32)
+    known_names = [None] * len(image_paths)
+    count = 0
+    
+    # Encode images in parallel; results come back in input order.
+    # Processes, not threads: dlib's detector and DNN objects in
+    # face_recognition.api are not safe to call concurrently. Each process
+    # loads every dlib model, so never start more than there are images.
+    results = []
+    if image_paths:
+        with ProcessPoolExecutor(
+            max_workers=min(len(image_paths), workers or available_cpus()),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as ex:
+            results = list(ex.map(_encode_one, image_paths))
+    
+    current_person = None
+    for (person_name, image_name, _), (encoding, error) in zip(image_paths, results):
+        if person_name != current_person:
+            print(f"Processing: {person_name}")
+            current_person = person_name
+        
+        if error is not None:
+            print(f"  ✗ Error loading {image_name}: {error}")
+        elif encoding is None:
+            print(f"  ✗ No face found in {image_name}")
+        else:
+            buf[count] = encoding
+            known_names[count] = person_name
+            count += 1
+            print(f"  ✓ {image_name}")
+    
+    known_encodings = normalize_rows(buf[:count])
+    known_names = known_names[:count]
     
     print(f"\n✓ Encoded {len(known_encodings)} faces from {len(set(known_names))} people\n")
     
     # Save encodings for faster loading next time
     if save_encodings and len(known_encodings) > 0:
-        with open('face_encodings.pkl', 'wb') as f:
-            pickle.dump({'encodings': known_encodings, 'names': known_names}, f)
-        print("✓ Saved encodings to face_encodings.pkl\n")
+        save_gallery(known_encodings, known_names)
+        print(f"✓ Saved encodings to {ENCODINGS_FILE} and {NAMES_FILE}\n")
     
     return known_encodings, known_names
 
@@ -100,11 +191,16 @@ def encode_known_faces(folder_path="known_faces", save_encodings=True):
 # === STEP 2: Load saved encodings ===
 def load_encodings():
     """Load previously saved encodings"""
-    if os.path.exists('face_encodings.pkl'):
-        with open('face_encodings.pkl', 'rb') as f:
-            data = pickle.load(f)
-            print(f"✓ Loaded {len(data['encodings'])} saved encodings\n")
-            return data['encodings'], data['names']
+    if not os.path.exists(ENCODINGS_FILE):
+        if os.path.exists(ARCHIVE_FILE):
+            unpack_archive()
+        elif os.path.exists(LEGACY_PICKLE_FILE):
+            convert_legacy_pickle()
+            print(f"✓ Converted {LEGACY_PICKLE_FILE} to {ENCODINGS_FILE} and {NAMES_FILE}")
+    if os.path.exists(ENCODINGS_FILE) and os.path.exists(NAMES_FILE):
+        known_encodings, known_names = load_gallery()
+        print(f"✓ Loaded {len(known_encodings)} saved encodings\n")
+        return known_encodings, known_names
     return None, None
 
 
@@ -116,33 +212,27 @@ def recognize_image(image_path, known_encodings, known_names, show_result=True):
     print(f"Processing: {image_path}")
     
     # Load the image
-    image = face_recognition.load_image_file(image_path)
+    image = load_image_upright(image_path)
     
     # Find all face locations and encodings
     face_locations = face_recognition.face_locations(image)
-    face_encodings = face_recognition.face_encodings(image, face_locations)
+    face_encodings = batch_face_encodings(image, face_locations)
     
     print(f"Found {len(face_locations)} face(s)\n")
     
     # Convert to BGR for OpenCV
     image_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
     
+    # Compare all faces with known faces at once
+    matches = match_faces(known_encodings, known_names, face_encodings)
+    
     # Process each face
-    for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-        # Compare with known faces
-        matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
-        name = "Unknown"
+    for (top, right, bottom, left), (name, distance) in zip(face_locations, matches):
         confidence = 0
         
-        # Find best match
-        if True in matches:
-            face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-            best_match_index = face_distances.argmin()
-            
-            if matches[best_match_index]:
-                name = known_names[best_match_index]
-                confidence = (1 - face_distances[best_match_index]) * 100
-                print(f"  → {name} ({confidence:.1f}% confident)")
+        if name != "Unknown":
+            confidence = (1 - distance) * 100
+            print(f"  → {name} ({confidence:.1f}% confident)")
         
         if name == "Unknown":
             print(f"  → Unknown person")
@@ -186,8 +276,13 @@ def recognize_webcam(known_encodings, known_names):
         print("Error: Could not open webcam")
         return
     
+    index = build_index(known_encodings)
     process_this_frame = True
     
+    # Quarter-size buffers reused across frames (allocated on the first frame)
+    small_frame = None
+    rgb_small_frame = None
+    
     while True:
         ret, frame = video_capture.read()
         
@@ -196,27 +291,25 @@ def recognize_webcam(known_encodings, known_names):
         
         # Process every other frame for speed
         if process_this_frame:
+            h, w = frame.shape[:2]
+            if small_frame is None or small_frame.shape[:2] != (h // 4, w // 4):
+                small_frame = np.empty((h // 4, w // 4, 3), np.uint8)
+                rgb_small_frame = np.empty_like(small_frame)
+            
             # Resize for faster processing
-            small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+            cv2.resize(frame, (w // 4, h // 4), dst=small_frame, interpolation=cv2.INTER_NEAREST)
+            cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB, dst=rgb_small_frame)
             
             # Find faces
             face_locations = face_recognition.face_locations(rgb_small_frame)
-            face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+            face_encodings = batch_face_encodings(rgb_small_frame, face_locations)
             
-            face_names = []
-            for face_encoding in face_encodings:
-                matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
-                name = "Unknown"
-                
-                if True in matches:
-                    face_distances = face_recognition.face_distance(known_encodings, face_encoding)
-                    best_match_index = face_distances.argmin()
-                    if matches[best_match_index]:
-                        name = known_names[best_match_index]
-                
-                face_names.append(name)
-
+            face_names = [
+                name for name, _ in match_faces(
+                    known_encodings, known_names, face_encodings, index=index
+                )
+            ]
+            for name in face_names:
                 # ✅ Log attendance if employee recognized
                 if name != "Unknown":
                     mark_attendance(name)
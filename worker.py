@@ -0,0 +1,89 @@
+# Recognition pipeline run inside the app's worker processes.
+# Only pool workers import this module, so the web process never loads
+# the dlib models or initialises CUDA.
+import os
+import cv2
+import dlib
+import face_recognition
+import numpy as np
+
+from gallery import (
+    ENCODINGS_FILE,
+    NAMES_FILE,
+    available_cpus,
+    build_index,
+    load_gallery,
+    match_faces,
+    to_matrix,
+)
+from main import batch_face_encodings, encode_known_faces
+
+DETECT_MAX_SIDE = 640  # long side (px) used for face detection
+REDUCED_2_BYTES = 1_000_000  # uploads above this are decoded at 1/2 resolution
+REDUCED_4_BYTES = 4_000_000  # uploads above this are decoded at 1/4 resolution
+# Same budget as the app's recognition pool; bounds /reencode's encoding processes
+REENCODE_WORKERS = int(os.environ.get("RECOGNITION_WORKERS", available_cpus()))
+
+known_encodings, known_names, known_index = to_matrix([]), [], None
+
+# === Worker start-up ===
+def init_worker():
+    """Map the saved gallery, so each new pool sees the latest /reencode."""
+    global known_encodings, known_names, known_index
+
+    if dlib.DLIB_USE_CUDA:
+        print(f"✅ Worker {os.getpid()}: dlib built with CUDA ({dlib.cuda.get_num_devices()} device(s))")
+    else:
+        print(f"ℹ️ Worker {os.getpid()}: dlib running on CPU (built without CUDA)")
+
+    if os.path.exists(ENCODINGS_FILE) and os.path.exists(NAMES_FILE):
+        known_encodings, known_names = load_gallery(ENCODINGS_FILE, NAMES_FILE)
+    known_index = build_index(known_encodings)
+
+# === Recognize faces in an uploaded image ===
+def recognize_bytes(img_bytes):
+    """
+    Blocking decode -> detect -> encode -> match pipeline.
+    Returns the recognized names, or None if the bytes are not an image.
+    """
+    np_arr = np.frombuffer(img_bytes, np.uint8)
+
+    # Large uploads are scaled down inside libjpeg's IDCT while decoding
+    if np_arr.nbytes > REDUCED_4_BYTES:
+        flag = cv2.IMREAD_REDUCED_COLOR_4
+    elif np_arr.nbytes > REDUCED_2_BYTES:
+        flag = cv2.IMREAD_REDUCED_COLOR_2
+    else:
+        flag = cv2.IMREAD_COLOR
+    image = cv2.imdecode(np_arr, flag)
+
+    if image is None:
+        return None
+
+    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # Detect on a downscaled copy to bound HOG cost, then map boxes back
+    h, w = rgb_image.shape[:2]
+    scale = DETECT_MAX_SIDE / max(h, w)
+    if scale < 1:
+        small = cv2.resize(rgb_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        face_locations = [
+            (int(top / scale), int(right / scale), int(bottom / scale), int(left / scale))
+            for top, right, bottom, left in face_recognition.face_locations(small)
+        ]
+    else:
+        face_locations = face_recognition.face_locations(rgb_image)
+
+    face_encodings = batch_face_encodings(rgb_image, face_locations)
+
+    return [
+        name for name, _ in match_faces(
+            known_encodings, known_names, face_encodings, index=known_index
+        )
+    ]
+
+# === Re-encode the dataset folder ===
+def reencode(folder_path):
+    """Encode and save the gallery; returns the number of faces encoded."""
+    encodings, _ = encode_known_faces(folder_path, save_encodings=True, workers=REENCODE_WORKERS)
+    return len(encodings)